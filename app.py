@@ -12,15 +12,27 @@ import hashlib
 import ssl
 import socket
 import time
-from urllib.parse import urljoin, urlparse, urlunparse
-from urllib.request import Request, build_opener, HTTPCookieProcessor, HTTPSHandler
+import heapq
+import itertools
+import zlib
+import sys
+import sqlite3
+from array import array
+from functools import lru_cache
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from urllib.parse import urljoin, urlparse, urlunparse, quote
+from urllib.request import Request, build_opener, HTTPCookieProcessor, HTTPHandler, HTTPSHandler
 from urllib.error import URLError, HTTPError
+from urllib.robotparser import RobotFileParser
 from http.cookiejar import CookieJar
-from threading import Thread, Lock
+import http.client
+from threading import Thread, Lock, Event, Condition
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from flask import Flask, render_template, send_from_directory, abort
+from flask import Flask, Response, render_template, send_from_directory, abort
 from flask_socketio import SocketIO
 from bs4 import BeautifulSoup
+from cleanup import Housekeeper
 import ipaddress
 import secrets
 
@@ -38,6 +50,15 @@ REQUEST_LIMIT = defaultdict(list)  # IP -> [时间戳]
 MAX_REQUESTS_PER_MINUTE = 5
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 单文件50MB限制
 MAX_TOTAL_SIZE = 200 * 1024 * 1024  # 总大小200MB限制
+MAX_PAGES = int(os.environ.get('MAX_PAGES', 5000))  # 单站页面预算，按优先级裁掉低价值页面
+
+# robots.txt / sitemap
+MAX_CRAWL_DELAY = 5                  # robots.txt Crawl-delay上限（秒）
+MAX_SITEMAPS = 20                    # 最多读取的sitemap文件数（含索引）
+MAX_SITEMAP_URLS = 50000             # sitemap最多导入的页面数
+MAX_SITEMAP_SIZE = 10 * 1024 * 1024  # 单个sitemap解压后大小上限
+FRONTIER_MEMORY_LIMIT = 20000       # 待爬队列内存中最多保留的条目数，超出部分写入磁盘
+PAGINATION_RE = re.compile(r'(/page/\d+/?$)|([?&](page|paged|p|offset|start)=\d+)', re.IGNORECASE)
 
 # 目录配置
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -47,6 +68,17 @@ SITES_DIR = os.path.join(BASE_DIR, 'static', 'sites')
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 os.makedirs(SITES_DIR, exist_ok=True)
 
+# 存储管理: 进程内索引，按配额LRU淘汰ZIP并及时清理临时目录（首个任务或下载时启动）
+HOUSEKEEPER = Housekeeper(SITES_DIR, DOWNLOAD_DIR)
+
+# 下载分发: 可交给前端代理发送文件，不占用gunicorn worker
+# SENDFILE_MODE: 空=Flask直接发送, nginx=X-Accel-Redirect, x-sendfile=Apache/Lighttpd的X-Sendfile
+SENDFILE_MODE = os.environ.get('SENDFILE_MODE', '').lower()
+ACCEL_REDIRECT_PREFIX = os.environ.get('ACCEL_REDIRECT_PREFIX', '/_protected/sites/')
+app.config['USE_X_SENDFILE'] = SENDFILE_MODE == 'x-sendfile'
+STREAM_CHUNK_SIZE = 64 * 1024
+TOKEN_RE = re.compile(r'[A-Za-z0-9]{8,64}')  # 客户端任务token，同时用于文件名
+
 # 请求头
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -69,6 +101,156 @@ def is_private_ip(hostname):
         # 不是IP地址，是域名
         return hostname.lower() in BLOCKED_HOSTS
 
+# DNS缓存: 进程内共享，解析结果同时用于安全检查和实际连接(防DNS重绑定)
+DNS_CACHE_TTL = 300          # 解析成功缓存时间（秒）
+DNS_NEGATIVE_TTL = 30        # 解析失败/被禁止的缓存时间（秒）
+DNS_PREFETCH_WORKERS = 8
+DNS_CACHE_MAX_ENTRIES = 10000  # 超出时先清理过期条目，仍超出则淘汰最早过期的
+
+
+class DNSCache:
+    """线程安全的DNS解析缓存，只返回通过安全检查的公网IP列表"""
+    
+    def __init__(self, ttl=DNS_CACHE_TTL, negative_ttl=DNS_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}         # host -> (过期时间, IP元组或None)
+        self.inflight = {}        # host -> Event，合并同一域名的并发解析
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=DNS_PREFETCH_WORKERS)
+    
+    def _lookup(self, host):
+        """实际解析，任一地址为内网即视为不安全"""
+        try:
+            infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except (socket.gaierror, UnicodeError, OSError):
+            return None
+        ips = []
+        for info in infos:
+            ip = info[4][0].split('%')[0]
+            if is_private_ip(ip):
+                return None
+            if ip not in ips:
+                ips.append(ip)
+        return tuple(ips) or None
+    
+    def _prune(self, now):
+        """控制缓存大小（调用方持有锁）"""
+        for host in [h for h, e in self.entries.items() if e[0] <= now]:
+            del self.entries[host]
+        excess = len(self.entries) - DNS_CACHE_MAX_ENTRIES // 2
+        if len(self.entries) > DNS_CACHE_MAX_ENTRIES and excess > 0:
+            for host in sorted(self.entries, key=lambda h: self.entries[h][0])[:excess]:
+                del self.entries[host]
+    
+    def resolve(self, host):
+        """解析域名，返回已审核的IP元组（按解析顺序）；不安全或无法解析时返回None"""
+        if not host:
+            return None
+        host = host.lower().rstrip('.')
+        if is_private_ip(host):
+            return None
+        try:
+            ipaddress.ip_address(host)
+            return (host,)
+        except ValueError:
+            pass
+        
+        while True:
+            with self.lock:
+                entry = self.entries.get(host)
+                if entry and entry[0] > time.time():
+                    return entry[1]
+                event = self.inflight.get(host)
+                if event is None:
+                    event = self.inflight[host] = Event()
+                    break
+            # 其他线程正在解析同一域名，等待其结果
+            event.wait()
+        
+        ips = None
+        try:
+            ips = self._lookup(host)
+        finally:
+            with self.lock:
+                now = time.time()
+                ttl = self.ttl if ips else self.negative_ttl
+                self.entries[host] = (now + ttl, ips)
+                self.inflight.pop(host, None)
+                if len(self.entries) > DNS_CACHE_MAX_ENTRIES:
+                    self._prune(now)
+            event.set()
+        return ips
+    
+    def prefetch(self, hosts):
+        """后台并发预解析，不等待结果"""
+        now = time.time()
+        todo = []
+        with self.lock:
+            for host in {h.lower().rstrip('.') for h in hosts if h}:
+                entry = self.entries.get(host)
+                if host in self.inflight or (entry and entry[0] > now):
+                    continue
+                todo.append(host)
+        for host in todo:
+            self.executor.submit(self.resolve, host)
+
+
+DNS_CACHE = DNSCache()
+
+
+def pinned_create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """使用缓存中已审核的IP建立连接，保证安全检查与实际连接的是同一地址"""
+    host, port = address
+    ips = DNS_CACHE.resolve(host)
+    if ips is None:
+        raise OSError(f'禁止连接: {host}')
+    # 与socket.create_connection一致，依次尝试每个地址
+    error = None
+    for ip in ips:
+        try:
+            return socket.create_connection((ip, port), timeout, source_address)
+        except OSError as e:
+            error = e
+    raise error
+
+
+def via_proxy(req):
+    """请求是否经由代理；经代理时目标由代理解析，只做安全检查不固定IP"""
+    target = urlparse(req.full_url)
+    if req.host == target.netloc:
+        return False
+    if DNS_CACHE.resolve(target.hostname) is None:
+        raise URLError(f'禁止连接: {target.hostname}')
+    return True
+
+
+class PinnedHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = pinned_create_connection
+
+
+class PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """连接固定IP，SNI和Host头仍使用原域名"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = pinned_create_connection
+
+
+class PinnedHTTPHandler(HTTPHandler):
+    def http_open(self, req):
+        conn_class = http.client.HTTPConnection if via_proxy(req) else PinnedHTTPConnection
+        return self.do_open(conn_class, req)
+
+
+class PinnedHTTPSHandler(HTTPSHandler):
+    def https_open(self, req):
+        conn_class = http.client.HTTPSConnection if via_proxy(req) else PinnedHTTPSConnection
+        return self.do_open(conn_class, req, context=self._context)
+
+
 def is_safe_url(url):
     """检查URL是否安全"""
     try:
@@ -91,6 +273,10 @@ def is_safe_url(url):
         # 检查协议
         if parsed.scheme not in ('http', 'https'):
             return False
+        
+        # 检查解析结果（域名指向内网同样禁止）
+        if DNS_CACHE.resolve(parsed.hostname) is None:
+            return False
             
         return True
     except:
@@ -156,25 +342,228 @@ def download_file(filename):
     # 只允许.zip文件
     if not filename.endswith('.zip'):
         abort(403)
-    return send_from_directory(SITES_DIR, filename, as_attachment=True)
+    
+    HOUSEKEEPER.touch(filename)
+    
+    if SENDFILE_MODE == 'nginx':
+        if not os.path.isfile(os.path.join(SITES_DIR, filename)):
+            abort(404)
+        # 由nginx internal location发送文件（自带Range/断点续传）
+        response = Response(mimetype='application/zip')
+        response.headers['X-Accel-Redirect'] = ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + quote(filename)
+        response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+        return response
+    
+    # conditional: 支持Range断点续传和ETag/Last-Modified条件请求
+    return send_from_directory(SITES_DIR, filename, as_attachment=True, conditional=True, etag=True)
+
+
+@app.route('/stream/<token>')
+def stream_archive(token):
+    """爬取过程中边生成边下载ZIP"""
+    if not TOKEN_RE.fullmatch(token):
+        abort(403)
+    with LIVE_ARCHIVES_LOCK:
+        archive = LIVE_ARCHIVES.get(token)
+    if archive is None:
+        abort(404)
+    
+    response = Response(archive.iter_chunks(), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(archive.domain)}.zip"
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# 紧凑URL状态存储: 大站点(10万+URL)时每个任务的内存保持平稳
+UNSAFE_PATH_RE = re.compile(r'[<>:"|?*]')
+URL_SPLIT_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*)://([^/?#]*)(.*)$', re.DOTALL)
+
+
+def url_fingerprint(url):
+    """URL的64位指纹（0保留为空槽）"""
+    digest = hashlib.blake2b(url.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class FingerprintSet:
+    """基于array('Q')开放寻址的URL指纹集合，每个URL约16字节，只增不删"""
+    
+    __slots__ = ('table', 'count')
+    
+    def __init__(self, capacity=1024):
+        self.table = array('Q', bytes(8 * capacity))  # capacity须为2的幂
+        self.count = 0
+    
+    @staticmethod
+    def _probe(table, fp):
+        mask = len(table) - 1
+        i = fp & mask
+        while True:
+            value = table[i]
+            if value == 0 or value == fp:
+                return i
+            i = (i + 1) & mask
+    
+    def __contains__(self, url):
+        table = self.table
+        return table[self._probe(table, url_fingerprint(url))] != 0
+    
+    def __len__(self):
+        return self.count
+    
+    def add(self, url):
+        """加入集合，已存在时返回False（并发写入需由调用方加锁）"""
+        fp = url_fingerprint(url)
+        i = self._probe(self.table, fp)
+        if self.table[i]:
+            return False
+        self.table[i] = fp
+        self.count += 1
+        if self.count * 2 > len(self.table):
+            self._grow()
+        return True
+    
+    def _grow(self):
+        new = array('Q', bytes(16 * len(self.table)))
+        for fp in self.table:
+            if fp:
+                new[self._probe(new, fp)] = fp
+        self.table = new
+
+
+class FrontierEntry:
+    """待爬页面，协议和域名驻留共享，只单独保存路径部分"""
+    
+    __slots__ = ('priority', 'seq', 'scheme', 'host', 'rest', 'depth')
+    
+    def __init__(self, priority, seq, url, depth):
+        self.priority = priority
+        self.seq = seq
+        self.depth = depth
+        match = URL_SPLIT_RE.match(url)
+        if match:
+            self.scheme = sys.intern(match.group(1))
+            self.host = sys.intern(match.group(2))
+            self.rest = match.group(3)
+        else:
+            self.scheme = self.host = ''
+            self.rest = url
+    
+    @property
+    def url(self):
+        if not self.scheme:
+            return self.rest
+        return f"{self.scheme}://{self.host}{self.rest}"
+    
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Frontier:
+    """页面优先队列，超过内存上限时把低优先级的一半溢出到磁盘(sqlite)"""
+    
+    def __init__(self, spill_path, memory_limit=FRONTIER_MEMORY_LIMIT):
+        self.heap = []
+        self.seq = itertools.count()
+        self.spill_path = spill_path
+        self.memory_limit = memory_limit
+        self.spilled = 0
+        self.db = None
+    
+    def __len__(self):
+        return len(self.heap) + self.spilled
+    
+    def push(self, priority, url, depth):
+        heapq.heappush(self.heap, FrontierEntry(priority, next(self.seq), url, depth))
+        if len(self.heap) > self.memory_limit:
+            self._spill()
+    
+    def _spill(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.spill_path, check_same_thread=False)
+            # 溢出文件用完即删，不需要持久性保证，避免每次出队都fsync
+            self.db.execute('PRAGMA synchronous = OFF')
+            self.db.execute('PRAGMA journal_mode = OFF')
+            self.db.execute('CREATE TABLE frontier (priority REAL, seq INTEGER, url TEXT, depth INTEGER)')
+            self.db.execute('CREATE INDEX frontier_order ON frontier (priority, seq)')
+        # 有序列表本身就是合法的堆
+        self.heap.sort()
+        keep = self.memory_limit // 2
+        spill, self.heap = self.heap[keep:], self.heap[:keep]
+        with self.db:
+            self.db.executemany(
+                'INSERT INTO frontier VALUES (?, ?, ?, ?)',
+                ((e.priority, e.seq, e.url, e.depth) for e in spill)
+            )
+        self.spilled += len(spill)
+    
+    def pop(self):
+        """取出优先级最高的页面，返回 (url, 深度)"""
+        if self.spilled:
+            row = self.db.execute(
+                'SELECT rowid, priority, seq, url, depth FROM frontier ORDER BY priority, seq LIMIT 1'
+            ).fetchone()
+            if not self.heap or (row[1], row[2]) < (self.heap[0].priority, self.heap[0].seq):
+                with self.db:
+                    self.db.execute('DELETE FROM frontier WHERE rowid = ?', (row[0],))
+                self.spilled -= 1
+                return row[3], row[4]
+        entry = heapq.heappop(self.heap)
+        return entry.url, entry.depth
+    
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                pass
+
+
+@lru_cache(maxsize=8192)
+def url_to_relpath(url):
+    """URL转站点目录下的相对路径（按需计算，有限缓存）"""
+    parsed = urlparse(url)
+    path = parsed.path or '/index.html'
+    if path == '/':
+        path = '/index.html'
+    elif path.endswith('/'):
+        path += 'index.html'
+    elif '.' not in os.path.basename(path):
+        path += '.html'
+    
+    # 处理查询字符串
+    if parsed.query:
+        h = hashlib.md5(parsed.query.encode()).hexdigest()[:8]
+        base, ext = os.path.splitext(path)
+        path = f"{base}_{h}{ext}"
+    
+    path = path.lstrip('/')
+    return UNSAFE_PATH_RE.sub('_', path)
 
 
 class SimpleCrawler:
     """简洁可靠的网站爬虫"""
     
-    def __init__(self, url, save_dir, token, sio):
+    def __init__(self, url, save_dir, token, sio, archive=None):
         self.start_url = url
         self.save_dir = save_dir
         self.token = token
         self.sio = sio
+        self.archive = archive    # 可选: 边爬边写入的LiveArchive
         
         parsed = urlparse(url)
         self.domain = parsed.netloc
         self.scheme = parsed.scheme or 'https'
         
-        self.downloaded = {}      # url -> filepath
-        self.visited_pages = set()
-        self.pending_pages = []
+        self.downloaded = FingerprintSet()     # 已下载（或已开始下载）的资源
+        self.visited_pages = FingerprintSet()
+        self.seen_pages = FingerprintSet()     # 已加入队列的页面（含已访问）
+        self.pending_pages = Frontier(os.path.join(save_dir, '.frontier.db'))
+        self.crawl_delay = 0
+        self.next_fetch_at = 0    # 按Crawl-delay排队的下一次目标站请求时间
         self.lock = Lock()
         self.file_count = 0
         self.total_size = 0
@@ -189,12 +578,25 @@ class SimpleCrawler:
         self.sio.emit(self.token, {'progress': msg})
         print(msg, flush=True)
     
+    def wait_crawl_delay(self, url):
+        """目标站的请求(含并发的资源下载)按Crawl-delay依次预约时间片"""
+        if not self.crawl_delay or urlparse(url).netloc != self.domain:
+            return
+        with self.lock:
+            now = time.time()
+            wait = self.next_fetch_at - now
+            self.next_fetch_at = max(now, self.next_fetch_at) + self.crawl_delay
+        if wait > 0:
+            time.sleep(wait)
+    
     def fetch(self, url, retry=2, silent=False):
         """下载URL内容"""
         for i in range(retry):
+            self.wait_crawl_delay(url)
             try:
                 opener = build_opener(
-                    HTTPSHandler(context=self.ssl_ctx),
+                    PinnedHTTPHandler(),
+                    PinnedHTTPSHandler(context=self.ssl_ctx),
                     HTTPCookieProcessor(CookieJar())
                 )
                 req = Request(url)
@@ -213,45 +615,35 @@ class SimpleCrawler:
     
     def url_to_path(self, url):
         """URL转本地文件路径"""
-        parsed = urlparse(url)
-        path = parsed.path or '/index.html'
-        if path == '/':
-            path = '/index.html'
-        elif path.endswith('/'):
-            path += 'index.html'
-        elif '.' not in os.path.basename(path):
-            path += '.html'
-        
-        # 处理查询字符串
-        if parsed.query:
-            h = hashlib.md5(parsed.query.encode()).hexdigest()[:8]
-            base, ext = os.path.splitext(path)
-            path = f"{base}_{h}{ext}"
-        
-        path = path.lstrip('/')
-        path = re.sub(r'[<>:"|?*]', '_', path)
-        
         # 使用域名作为子目录
-        return os.path.join(self.save_dir, self.domain, path)
+        return os.path.join(self.save_dir, self.domain, url_to_relpath(url))
     
     def save(self, url, content, content_type=''):
-        """保存文件"""
+        """保存文件；有LiveArchive时直接写入归档，不再落盘目录树"""
         filepath = self.url_to_path(url)
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        
-        mode = 'wb' if isinstance(content, bytes) else 'w'
-        encoding = None if isinstance(content, bytes) else 'utf-8'
+        data = content if isinstance(content, bytes) else content.encode('utf-8')
         
-        with open(filepath, mode, encoding=encoding) as f:
-            f.write(content)
+        if self.archive is not None:
+            written = self.archive.add(url_to_relpath(url), data)
+            stored = written > 0  # 同名路径已在归档中时不写入
+        else:
+            stored = True
+            written = len(data)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            
+            mode = 'wb' if isinstance(content, bytes) else 'w'
+            encoding = None if isinstance(content, bytes) else 'utf-8'
+            
+            with open(filepath, mode, encoding=encoding) as f:
+                f.write(content)
         
         with self.lock:
-            self.downloaded[url] = filepath
-            self.file_count += 1
-            if isinstance(content, bytes):
-                self.total_size += len(content)
-            else:
-                self.total_size += len(content.encode('utf-8'))
+            self.downloaded.add(url)
+            if stored:
+                self.file_count += 1
+                self.total_size += len(data)
+        if written:
+            HOUSEKEEPER.job_progress(self.token, written)
         
         return filepath
     
@@ -398,10 +790,132 @@ class SimpleCrawler:
                 continue
             url = self.normalize_url(href, page_url)
             if url and self.is_same_domain(url):
-                if url not in self.visited_pages and url not in self.pending_pages:
+                if url not in self.seen_pages:
                     links.append(url)
         return links
     
+    def page_priority(self, url, depth, parent_url=None, sitemap_priority=None, lastmod=None):
+        """页面优先级，数值越小越先爬取"""
+        if depth == 0:
+            return float('-inf')  # 起始页始终最先
+        
+        score = float(depth)
+        
+        # sitemap中声明的priority(0~1)和最近更新时间
+        if sitemap_priority is not None:
+            score -= 2 * sitemap_priority
+        if lastmod:
+            try:
+                age_days = (datetime.now() - datetime.strptime(lastmod[:10], '%Y-%m-%d')).days
+                if age_days <= 30:
+                    score -= 0.5
+                elif age_days <= 365:
+                    score -= 0.25
+            except ValueError:
+                pass
+        
+        # 同栏目优先（第一级路径相同）
+        path = urlparse(url).path
+        ref_path = urlparse(parent_url or self.start_url).path
+        section = path.strip('/').split('/')[0]
+        if section and section == ref_path.strip('/').split('/')[0]:
+            score -= 0.5
+        
+        # 分页列表价值低，放到最后
+        if PAGINATION_RE.search(url):
+            score += 3
+        
+        return score
+    
+    def enqueue_page(self, url, depth, parent_url=None, sitemap_priority=None, lastmod=None):
+        """加入待爬队列"""
+        if not self.seen_pages.add(url):
+            return False
+        priority = self.page_priority(url, depth, parent_url, sitemap_priority, lastmod)
+        self.pending_pages.push(priority, url, depth)
+        return True
+    
+    def load_robots(self):
+        """读取robots.txt，返回其中声明的sitemap地址"""
+        robots_url = f"{self.scheme}://{self.domain}/robots.txt"
+        content, _ = self.fetch(robots_url, retry=1)
+        sitemaps = []
+        if content:
+            parser = RobotFileParser(robots_url)
+            parser.parse(content.decode('utf-8', errors='ignore').splitlines())
+            sitemaps = parser.site_maps() or []
+            
+            delay = parser.crawl_delay(HEADERS['User-Agent'])
+            if delay:
+                self.crawl_delay = min(float(delay), MAX_CRAWL_DELAY)
+                self.log(f"[robots] Crawl-delay: {self.crawl_delay} 秒")
+        
+        if not sitemaps:
+            sitemaps = [f"{self.scheme}://{self.domain}/sitemap.xml"]
+        return sitemaps
+    
+    def fetch_sitemap(self, url):
+        """下载并解析sitemap，支持gzip；返回XML根节点"""
+        content, _ = self.fetch(url, retry=1)
+        if not content:
+            return None
+        try:
+            if content[:2] == b'\x1f\x8b':
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                content = decompressor.decompress(content, MAX_SITEMAP_SIZE)
+                if decompressor.unconsumed_tail or not decompressor.eof:
+                    self.log(f"[sitemap] 跳过过大或不完整的站点地图: {url}")
+                    return None
+            elif len(content) > MAX_SITEMAP_SIZE:
+                self.log(f"[sitemap] 跳过过大的站点地图: {url}")
+                return None
+            return ET.fromstring(content)
+        except (zlib.error, ET.ParseError):
+            self.log(f"[sitemap] 无法解析站点地图: {url}")
+            return None
+    
+    def seed_from_sitemaps(self, sitemap_urls):
+        """从sitemap(含索引)批量导入页面"""
+        queue = [u for u in sitemap_urls if is_safe_url(u)]
+        seen = set()
+        count = 0
+        
+        while queue and len(seen) < MAX_SITEMAPS and count < MAX_SITEMAP_URLS:
+            sitemap_url = queue.pop(0)
+            if sitemap_url in seen:
+                continue
+            seen.add(sitemap_url)
+            
+            root = self.fetch_sitemap(sitemap_url)
+            if root is None:
+                continue
+            
+            for entry in root:
+                fields = {child.tag.rsplit('}', 1)[-1]: (child.text or '').strip() for child in entry}
+                loc = fields.get('loc')
+                if not loc:
+                    continue
+                if root.tag.endswith('sitemapindex'):
+                    if is_safe_url(loc):
+                        queue.append(loc)
+                    continue
+                
+                url = self.normalize_url(loc, sitemap_url)
+                if not url or urlparse(url).netloc != self.domain:
+                    continue
+                try:
+                    priority = float(fields['priority']) if fields.get('priority') else None
+                except ValueError:
+                    priority = None
+                depth = max(1, len([p for p in urlparse(url).path.split('/') if p]))
+                if self.enqueue_page(url, depth, sitemap_priority=priority, lastmod=fields.get('lastmod')):
+                    count += 1
+                    if count >= MAX_SITEMAP_URLS:
+                        break
+        
+        if count:
+            self.log(f"[sitemap] 从 {len(seen)} 个站点地图导入 {count} 个页面")
+    
     def process_css(self, css_content, css_url):
         """处理CSS中的url()引用"""
         def replace_url(match):
@@ -427,9 +941,8 @@ class SimpleCrawler:
     def download_resource(self, url):
         """下载单个资源"""
         with self.lock:
-            if url in self.downloaded:
+            if not self.downloaded.add(url):  # 先标记防止重复
                 return True
-            self.downloaded[url] = True  # 先标记防止重复
         
         content, content_type = self.fetch(url, silent=True)
         if content is None:
@@ -444,12 +957,10 @@ class SimpleCrawler:
             except:
                 pass
         
-        filepath = self.save(url, content, content_type)
-        with self.lock:
-            self.downloaded[url] = filepath
+        self.save(url, content, content_type)
         return True
     
-    def crawl_page(self, page_url):
+    def crawl_page(self, page_url, depth=0):
         """爬取单个页面"""
         if page_url in self.visited_pages:
             return
@@ -478,6 +989,10 @@ class SimpleCrawler:
         # 提取并并发下载资源
         resources = self.extract_resources(soup, page_url)
         new_resources = [r for r in resources if r not in self.downloaded]
+        links = self.extract_links(soup, page_url)
+        
+        # 预解析新发现的域名，与下载并行
+        DNS_CACHE.prefetch({urlparse(u).hostname for u in new_resources + links})
         
         if new_resources:
             self.log(f"  下载 {len(new_resources)} 个资源...")
@@ -485,11 +1000,11 @@ class SimpleCrawler:
                 list(executor.map(self.download_resource, new_resources))
             self.log(f"  资源下载完成")
         
-        # 提取链接
-        links = self.extract_links(soup, page_url)
+        # 新页面链接
         if links:
             self.log(f"  发现 {len(links)} 个新页面链接")
-            self.pending_pages.extend(links)
+            for link in links:
+                self.enqueue_page(link, depth + 1, parent_url=page_url)
         
         # 保存HTML
         self.save(page_url, html, content_type)
@@ -509,14 +1024,21 @@ class SimpleCrawler:
         
         start_time = time.time()
         
-        # 添加起始URL
-        self.pending_pages.append(self.start_url)
+        # 添加起始URL，并从robots.txt/sitemap批量导入页面
+        self.enqueue_page(self.start_url, 0)
+        self.seed_from_sitemaps(self.load_robots())
         
-        # 循环处理所有页面
-        while self.pending_pages:
-            page_url = self.pending_pages.pop(0)
-            if page_url not in self.visited_pages:
-                self.crawl_page(page_url)
+        # 按优先级处理页面，超出预算时剩下的都是低优先级页面
+        try:
+            while self.pending_pages and len(self.visited_pages) < MAX_PAGES:
+                page_url, depth = self.pending_pages.pop()
+                if page_url not in self.visited_pages:
+                    self.crawl_page(page_url, depth)
+            
+            if self.pending_pages:
+                self.log(f"[预算] 已达页面上限 {MAX_PAGES}，跳过 {len(self.pending_pages)} 个低优先级页面")
+        finally:
+            self.pending_pages.close()
         
         elapsed = time.time() - start_time
         
@@ -530,14 +1052,111 @@ class SimpleCrawler:
         return self.domain
 
 
-def create_zip(source_dir, zip_path):
-    """创建ZIP压缩包"""
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, source_dir)
-                zipf.write(file_path, arcname)
+class _AppendOnlyWriter:
+    """不提供seek/tell，使zipfile使用数据描述符，已写出的字节不会再被修改"""
+    
+    def __init__(self, fp):
+        self.fp = fp
+    
+    def write(self, data):
+        return self.fp.write(data)
+    
+    def flush(self):
+        self.fp.flush()
+
+
+class LiveArchive:
+    """边爬边写的ZIP，读者可在写入过程中跟随读取"""
+    
+    def __init__(self, token, domain):
+        self.domain = domain
+        self.path = os.path.join(DOWNLOAD_DIR, f'{token}.zip.part')
+        self.final_path = None
+        self.size = 0             # 已落盘、可供读取的字节数
+        self.done = False
+        self.failed = False
+        self.lock = Lock()
+        self.cond = Condition(self.lock)
+        self.fp = open(self.path, 'xb')  # 不覆盖同token的进行中归档
+        self.zipf = zipfile.ZipFile(_AppendOnlyWriter(self.fp), 'w', zipfile.ZIP_DEFLATED)
+    
+    @property
+    def count(self):
+        return len(self.zipf.filelist)
+    
+    def add(self, arcname, data):
+        """写入一个文件
+        
+        ZIP只能追加，已写出的条目无法替换，所以同名文件只保留第一次写入的内容
+        （原先写目录树再打包时保留的是最后一次）。返回归档增长的字节数。
+        """
+        with self.cond:
+            if self.done or arcname in self.zipf.NameToInfo:
+                return 0
+            self.zipf.writestr(arcname, data)
+            self.fp.flush()
+            previous, self.size = self.size, self.fp.tell()
+            self.cond.notify_all()
+            return self.size - previous
+    
+    def finish(self, final_path):
+        """写入中央目录并移动到最终位置"""
+        with self.cond:
+            self.zipf.close()
+            self.fp.flush()
+            self.size = self.fp.tell()
+            self.fp.close()
+            shutil.move(self.path, final_path)
+            self.final_path = final_path
+            self.done = True
+            self.cond.notify_all()
+    
+    def abort(self):
+        with self.cond:
+            if self.done:
+                return
+            try:
+                self.zipf.close()
+            except Exception:
+                pass
+            self.fp.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.done = True
+            self.failed = True
+            self.cond.notify_all()
+    
+    def iter_chunks(self, chunk_size=STREAM_CHUNK_SIZE):
+        """跟随写入进度输出ZIP内容，直到归档完成"""
+        with self.cond:
+            if self.failed:
+                raise IOError('归档生成失败')
+            fp = open(self.final_path or self.path, 'rb')
+        with fp:
+            offset = 0
+            while True:
+                with self.cond:
+                    while offset >= self.size and not self.done:
+                        self.cond.wait(timeout=1)
+                    size, done, failed = self.size, self.done, self.failed
+                if failed:
+                    # 中断连接，让客户端认为下载失败，而不是收到截断的ZIP
+                    raise IOError('归档生成失败')
+                if done and offset >= size:
+                    return
+                fp.seek(offset)
+                data = fp.read(min(chunk_size, size - offset))
+                if not data:
+                    return
+                offset += len(data)
+                yield data
+
+
+# token -> 正在生成的LiveArchive（None表示任务已受理、归档尚未创建）
+LIVE_ARCHIVES = {}
+LIVE_ARCHIVES_LOCK = Lock()
 
 
 def download_website(token, website):
@@ -552,35 +1171,52 @@ def download_website(token, website):
     domain = parsed.netloc
     if not domain:
         socketio.emit(token, {'progress': '错误：无效的URL'})
+        with LIVE_ARCHIVES_LOCK:
+            LIVE_ARCHIVES.pop(token, None)
         return
     
+    try:
+        archive = LiveArchive(token, domain)
+    except FileExistsError:
+        # 其他进程中同token的任务仍在进行
+        socketio.emit(token, {'progress': '错误：该任务正在进行中'})
+        with LIVE_ARCHIVES_LOCK:
+            LIVE_ARCHIVES.pop(token, None)
+        return
+    with LIVE_ARCHIVES_LOCK:
+        LIVE_ARCHIVES[token] = archive
+    
     work_dir = os.path.join(DOWNLOAD_DIR, token)
+    HOUSEKEEPER.job_started(token)
     os.makedirs(work_dir, exist_ok=True)
+    socketio.emit(token, {'progress': '可边爬取边下载ZIP', 'stream': f'/stream/{token}'})
     
     try:
-        crawler = SimpleCrawler(website, work_dir, token, socketio)
+        crawler = SimpleCrawler(website, work_dir, token, socketio, archive=archive)
         domain = crawler.crawl()
         
         socketio.emit(token, {'progress': 'Converting'})
         
-        downloaded_dir = os.path.join(work_dir, domain)
-        
-        if os.path.exists(downloaded_dir) and os.listdir(downloaded_dir):
+        if archive.count:
             zip_path = os.path.join(SITES_DIR, f"{domain}.zip")
-            create_zip(downloaded_dir, zip_path)
-            shutil.rmtree(work_dir, ignore_errors=True)
+            archive.finish(zip_path)
+            HOUSEKEEPER.add_archive(zip_path, token)
             socketio.emit(token, {'progress': 'Completed', 'file': domain})
         else:
+            archive.abort()
             socketio.emit(token, {'progress': '错误：下载失败'})
-            shutil.rmtree(work_dir, ignore_errors=True)
             
     except Exception as e:
         # 安全: 不暴露详细错误信息
         print(f"[ERROR] {str(e)}")
         import traceback
         traceback.print_exc()  # 只在服务器日志记录
+        archive.abort()
         socketio.emit(token, {'progress': '错误：下载失败，请稍后重试'})
-        shutil.rmtree(work_dir, ignore_errors=True)
+    finally:
+        with LIVE_ARCHIVES_LOCK:
+            LIVE_ARCHIVES.pop(token, None)
+        HOUSEKEEPER.job_finished(token)
 
 
 @socketio.on('connect')
@@ -598,6 +1234,10 @@ def handle_request(data):
     token = data.get('token')
     website = data.get('website')
     
+    # 安全: token用于文件名，只允许字母数字
+    if not isinstance(token, str) or not TOKEN_RE.fullmatch(token):
+        return
+    
     # 安全: 速率限制
     from flask import request
     client_ip = request.remote_addr or 'unknown'
@@ -617,6 +1257,13 @@ def handle_request(data):
         socketio.emit(token, {'progress': '错误：不允许的URL'})
         return
     
+    # 同一token同时只能有一个任务，否则会共用归档和临时目录
+    with LIVE_ARCHIVES_LOCK:
+        if token in LIVE_ARCHIVES:
+            socketio.emit(token, {'progress': '错误：该任务正在进行中'})
+            return
+        LIVE_ARCHIVES[token] = None  # 占位，download_website中替换为LiveArchive
+    
     print(f"收到请求: {website} (IP: {client_ip})")
     
     thread = Thread(target=download_website, args=(token, website))
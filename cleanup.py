@@ -1,26 +1,38 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
-定时清理脚本 - 清理打包的源码文件
-用于宝塔定时任务执行
+存储清理 - 清理打包的源码文件
+
+app.py 运行时通过 Housekeeper 在进程内维护索引、按配额淘汰并及时清理临时目录，
+不再需要定时任务；本脚本保留用于手动清理。
 
 使用方法:
-  python cleanup.py           # 清理超过24小时的文件
-  python cleanup.py --hours 6 # 清理超过6小时的文件
-  python cleanup.py --all     # 清理所有文件
+  python cleanup.py                 # 清理超过24小时的文件
+  python cleanup.py --hours 6       # 清理超过6小时的文件
+  python cleanup.py --all           # 清理所有文件
+  python cleanup.py --quota-mb 1024 # 另外按配额淘汰最久未修改的ZIP
 """
 
 import os
 import shutil
 import time
 import argparse
+from collections import OrderedDict
 from datetime import datetime
+from threading import Thread, Lock
 
 # 目录配置
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 SITES_DIR = os.path.join(BASE_DIR, 'static', 'sites')      # ZIP文件目录
 DOWNLOAD_DIR = os.path.join(BASE_DIR, 'downloads')         # 临时下载目录
 
+# 配额与保留策略
+DISK_QUOTA = int(os.environ.get('DISK_QUOTA_MB', 2048)) * 1024 * 1024  # ZIP+工作目录总配额
+RETENTION_HOURS = float(os.environ.get('RETENTION_HOURS', 24))         # ZIP最久未下载的保留时间
+SWEEP_INTERVAL = 600                                                   # 后台巡检间隔（秒）
+ORPHAN_GRACE = 1800                                                    # 临时文件超过该时间未更新才视为遗留（秒）
+HEARTBEAT_INTERVAL = 60                                                # 运行中任务刷新工作目录mtime的间隔（秒）
+
 def get_file_age_hours(file_path):
     """获取文件存在时间（小时）"""
     try:
@@ -84,10 +96,243 @@ def cleanup_directory(directory, max_hours=None, extensions=None):
     
     return deleted_count, deleted_size
 
+class ArchiveEntry:
+    """ZIP索引记录"""
+    
+    __slots__ = ('name', 'size', 'created', 'last_access')
+    
+    def __init__(self, name, size, created, last_access=None):
+        self.name = name
+        self.size = size
+        self.created = created
+        self.last_access = last_access or created
+
+
+class Housekeeper:
+    """进程内存储管理: 维护ZIP和工作目录索引，按总配额淘汰最久未下载的ZIP"""
+    
+    def __init__(self, sites_dir=SITES_DIR, download_dir=DOWNLOAD_DIR,
+                 quota=DISK_QUOTA, retention_hours=RETENTION_HOURS):
+        self.sites_dir = sites_dir
+        self.download_dir = download_dir
+        self.quota = quota
+        self.retention_hours = retention_hours
+        self.archives = OrderedDict()  # 文件名 -> ArchiveEntry，按最近下载时间排序
+        self.jobs = {}                 # token -> 任务已用字节（工作目录 + .zip.part）
+        self.heartbeats = {}           # token -> 上次刷新工作目录mtime的时间
+        self.archive_size = 0
+        self.job_size = 0
+        self.started = False
+        self.lock = Lock()
+    
+    @property
+    def total_size(self):
+        return self.archive_size + self.job_size
+    
+    def scan(self):
+        """启动时扫描一次ZIP目录重建索引（只stat，不遍历子目录）"""
+        entries = []
+        if os.path.exists(self.sites_dir):
+            for item in os.listdir(self.sites_dir):
+                if not item.endswith('.zip'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.sites_dir, item))
+                except OSError:
+                    continue
+                entries.append(ArchiveEntry(item, st.st_size, st.st_mtime))
+        
+        with self.lock:
+            self.archives.clear()
+            self.archive_size = 0
+            for entry in sorted(entries, key=lambda e: e.last_access):
+                self.archives[entry.name] = entry
+                self.archive_size += entry.size
+    
+    def start(self, recent=None):
+        """重建索引、清理遗留目录并启动后台巡检；重复调用无效
+        
+        由首个任务或下载请求触发，而不是在导入时启动，
+        避免reloader父进程等不处理任务的进程也去清理文件。
+        recent为触发启动的下载文件名，在按配额淘汰之前先记为最近下载。
+        """
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        self.scan()
+        if recent:
+            self._mark_recent(recent)
+        self.remove_orphans()
+        self.enforce_quota()
+        thread = Thread(target=self._sweep_loop, daemon=True)
+        thread.start()
+    
+    def _sweep_loop(self):
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            try:
+                self.expire(self.retention_hours)
+                self.remove_orphans()
+            except Exception as e:
+                print(f"  [错误] 存储巡检失败: {e}")
+    
+    def _delete(self, path):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"  [错误] 无法删除 {path}: {e}")
+    
+    def remove_orphans(self):
+        """删除遗留的 downloads/<token>* 目录和文件
+        
+        其他进程（多worker、reloader）的任务不在本进程的jobs中，
+        所以只删除超过ORPHAN_GRACE未更新的文件；运行中的任务会定期刷新mtime。
+        """
+        if not os.path.exists(self.download_dir):
+            return 0
+        with self.lock:
+            active = set(self.jobs)
+        deadline = time.time() - ORPHAN_GRACE
+        count = 0
+        for item in os.listdir(self.download_dir):
+            token = item.split('.', 1)[0]
+            if token in active:
+                continue
+            path = os.path.join(self.download_dir, item)
+            try:
+                if os.path.getmtime(path) > deadline:
+                    continue
+            except OSError:
+                continue
+            self._delete(path)
+            count += 1
+            print(f"  [删除] 遗留临时文件 {item}")
+        return count
+    
+    def job_started(self, token):
+        """登记任务，须在创建工作目录之前调用"""
+        self.start()
+        with self.lock:
+            self.jobs[token] = 0
+            self.heartbeats[token] = time.time()
+    
+    def job_progress(self, token, nbytes):
+        """任务写入了nbytes，超出配额时淘汰旧ZIP"""
+        now = time.time()
+        with self.lock:
+            if token not in self.jobs:
+                return
+            self.jobs[token] += nbytes
+            self.job_size += nbytes
+            beat = now - self.heartbeats.get(token, 0) >= HEARTBEAT_INTERVAL
+            if beat:
+                self.heartbeats[token] = now
+        if beat:
+            # 刷新工作目录mtime，其他进程据此判断任务仍在运行
+            try:
+                os.utime(os.path.join(self.download_dir, token))
+            except OSError:
+                pass
+        if self.total_size > self.quota:
+            self.enforce_quota()
+    
+    def _release_job(self, token):
+        with self.lock:
+            self.job_size -= self.jobs.pop(token, 0)
+            self.heartbeats.pop(token, None)
+    
+    def job_finished(self, token):
+        """任务结束（成功或失败），立即删除其工作目录和残留的.zip.part"""
+        self._release_job(token)
+        self._delete(os.path.join(self.download_dir, token))
+        self._delete(os.path.join(self.download_dir, token + '.zip.part'))
+    
+    def add_archive(self, zip_path, token=None):
+        """登记新生成的ZIP，同名文件覆盖旧记录；token对应任务的用量转为该ZIP"""
+        if token is not None:
+            self._release_job(token)
+        name = os.path.basename(zip_path)
+        try:
+            size = os.path.getsize(zip_path)
+        except OSError:
+            return
+        now = time.time()
+        with self.lock:
+            old = self.archives.pop(name, None)
+            if old:
+                self.archive_size -= old.size
+            self.archives[name] = ArchiveEntry(name, size, now)
+            self.archive_size += size
+        self.enforce_quota(protect=name)
+    
+    def _mark_recent(self, name):
+        with self.lock:
+            entry = self.archives.get(name)
+            if entry:
+                entry.last_access = time.time()
+                self.archives.move_to_end(name)
+    
+    def touch(self, name):
+        """记录一次下载，移到LRU队尾"""
+        if not self.started:
+            # 首次启动会按配额淘汰，正在下载的文件须先移到队尾
+            self.start(recent=name)
+        self._mark_recent(name)
+    
+    def _evict_oldest(self, protect=None):
+        """从索引中取出最久未下载的ZIP，没有可淘汰的返回None（调用方持有锁）"""
+        for name in self.archives:
+            if name != protect:
+                break
+        else:
+            return None
+        entry = self.archives.pop(name)
+        self.archive_size -= entry.size
+        return entry
+    
+    def enforce_quota(self, protect=None):
+        """超出配额时按LRU淘汰，返回删除的数量和大小"""
+        evicted = []
+        with self.lock:
+            while self.total_size > self.quota:
+                entry = self._evict_oldest(protect)
+                if entry is None:
+                    break
+                evicted.append(entry)
+        for entry in evicted:
+            self._delete(os.path.join(self.sites_dir, entry.name))
+            print(f"  [配额] 删除 {entry.name} ({entry.size / 1024:.1f} KB)")
+        return len(evicted), sum(e.size for e in evicted)
+    
+    def expire(self, max_hours):
+        """删除超过max_hours未下载的ZIP"""
+        deadline = time.time() - max_hours * 3600
+        expired = []
+        with self.lock:
+            while self.archives:
+                entry = next(iter(self.archives.values()))
+                if entry.last_access >= deadline:
+                    break
+                self.archives.popitem(last=False)
+                self.archive_size -= entry.size
+                expired.append(entry)
+        for entry in expired:
+            self._delete(os.path.join(self.sites_dir, entry.name))
+            print(f"  [过期] 删除 {entry.name} ({entry.size / 1024:.1f} KB)")
+        return len(expired), sum(e.size for e in expired)
+
+
 def main():
     parser = argparse.ArgumentParser(description='清理打包的源码文件')
     parser.add_argument('--hours', type=int, default=24, help='保留时间（小时），默认24小时')
     parser.add_argument('--all', action='store_true', help='清理所有文件，忽略时间限制')
+    parser.add_argument('--quota-mb', type=int, default=None, help='清理后ZIP总大小超过该值时，删除最久未修改的ZIP')
     args = parser.parse_args()
     
     max_hours = None if args.all else args.hours
@@ -118,6 +363,16 @@ def main():
     total_size += size
     print(f"    删除 {count} 个文件/目录，释放 {size / 1024 / 1024:.2f} MB")
     
+    # 按配额淘汰
+    if args.quota_mb is not None:
+        print(f"\n[3] 按配额清理ZIP: {args.quota_mb} MB")
+        keeper = Housekeeper(quota=args.quota_mb * 1024 * 1024)
+        keeper.scan()
+        count, size = keeper.enforce_quota()
+        total_count += count
+        total_size += size
+        print(f"    删除 {count} 个文件，释放 {size / 1024 / 1024:.2f} MB")
+    
     print("\n" + "=" * 50)
     print(f"清理完成!")
     print(f"总计删除: {total_count} 个文件/目录")
@@ -2,6 +2,8 @@ document.addEventListener('DOMContentLoaded', function() {
     var numberOfFiles = 0;
     var numberOfPages = 0;
     var downloadFile = '';
+    var streamUrl = '';
+    var running = false;
     var logLines = [];
     
     var socket = io();
@@ -31,6 +33,17 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     socket.on(myToken, function(event) {
+        if (event.stream) {
+            // 爬取过程中即可开始下载
+            streamUrl = event.stream;
+            zipDownloadBtn.textContent = '边爬边下载 ZIP';
+            zipDownloadBtn.style.display = 'inline-block';
+        }
+        if (event.progress === 'Completed' || event.progress.indexOf('错误') !== -1) {
+            // 任务结束后才允许发起下一个任务
+            running = false;
+            downloadBtn.disabled = !validateUrl(websiteInput.value);
+        }
         if (event.progress === 'Converting') {
             progressText.textContent = '压缩中...';
             addLog('正在压缩文件...', 'info');
@@ -38,9 +51,16 @@ document.addEventListener('DOMContentLoaded', function() {
             spinner.style.display = 'none';
             progressText.textContent = '完成';
             downloadFile = event.file;
+            streamUrl = '';
             addLog('下载完成!', 'success');
+            zipDownloadBtn.textContent = '下载 ZIP';
             zipDownloadBtn.style.display = 'inline-block';
         } else if (event.progress.indexOf('Error') !== -1 || event.progress.indexOf('错误') !== -1) {
+            if (streamUrl) {
+                // 归档已中止，边爬边下载的地址不再可用
+                streamUrl = '';
+                zipDownloadBtn.style.display = 'none';
+            }
             addLog(event.progress, 'error');
         } else {
             progressArea.style.display = 'block';
@@ -70,15 +90,19 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     websiteInput.addEventListener('input', function() {
-        downloadBtn.disabled = !validateUrl(this.value);
+        downloadBtn.disabled = running || !validateUrl(this.value);
         alertMessage.style.display = (this.value && !validateUrl(this.value)) ? 'block' : 'none';
     });
     
     downloadBtn.addEventListener('click', function() {
-        if (!validateUrl(websiteInput.value)) return;
+        if (running || !validateUrl(websiteInput.value)) return;
+        running = true;
+        downloadBtn.disabled = true;
         numberOfFiles = 0;
         numberOfPages = 0;
         logLines = [];
+        downloadFile = '';
+        streamUrl = '';
         nFilesSpan.textContent = '0';
         nPagesSpan.textContent = '0';
         zipDownloadBtn.style.display = 'none';
@@ -96,6 +120,8 @@ document.addEventListener('DOMContentLoaded', function() {
         // 安全: 防止文件名注入
         if (downloadFile && /^[a-zA-Z0-9][a-zA-Z0-9._-]*$/.test(downloadFile)) {
             window.location = '/sites/' + encodeURIComponent(downloadFile) + '.zip';
+        } else if (streamUrl && /^\/stream\/[a-zA-Z0-9]+$/.test(streamUrl)) {
+            window.location = streamUrl;
         }
     });
     